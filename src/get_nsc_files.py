@@ -4,12 +4,17 @@ This script connects to an NSC FTP/SFTP server, retrieves files, and logs the op
 Modules:
     os: Provides a way of using operating system dependent functionality.
     re: Provides regular expression matching operations.
+    shlex: Splits the import commands into arguments.
+    subprocess: Runs the import commands alongside the downloads.
+    time: Formats the file timestamps for the log file.
+    collections: Provides the deque of running import commands.
+    concurrent.futures: Runs the SFTP downloads on a pool of worker threads.
     datetime: Supplies classes for manipulating dates and times.
     pathlib: Offers classes to handle filesystem paths.
     typing: Provides runtime support for type hints.
-    csv: Implements classes to read and write tabular data in CSV format.
     paramiko: Implements the SSH2 protocol for secure (encrypted and authenticated) connections to remote machines.
-    yaml: Provides YAML parsing and emitting capabilities.
+    sftp_pool: A pool of open SFTP connections to the NSC server.
+    support_scripts: Shared helpers for locating and loading the YAML configuration and writing the log file.
 
 Constants:
     CURRENT_DATETIME: The current date and time when the script is run.
@@ -26,21 +31,24 @@ These items need to be replaced with a more dynamic approach (see pycolleague fo
 
 import os
 import re
+import shlex
+import subprocess
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, Final, Optional
+from typing import Any, Deque, Dict, Final, List, Optional, Set, Tuple
 
-import csv
 import paramiko
 
 # import polars as pl
 # import polars.selectors as cs
-import yaml
-from paramiko import Transport
 
 from pathlib import Path
 
-from support_scripts import find_root, merge_dicts
+from sftp_pool import close_pools, get_pool
+from support_scripts import AsyncCSVLogger, find_root, load_config
 
 ####
 # %% Constants
@@ -62,6 +70,81 @@ NSC_CONFIG_FILE: Final[Path] = Path(NSC_PATH / "nscconfig.yml")
 # The current path of this script file
 SCRIPT_PATH: Final[Path] = Path(__file__).resolve().parent
 
+# The file names on the FTP server are in the format of "CCCCCCCC_IIIIII_TYPE_MODE_MMDDYYYYHHMMSS_fn.ext".
+# The TYPE section is one of: AGGRRPT, ANALYSISRDY, CNTLRPT, or DETLRPT.
+# The MODE section is one of: DA, SE, or PA.
+# The pattern is broken down into named groups for clarity
+NSC_FILENAME_RE: Final[re.Pattern] = re.compile(
+    r"^"  # Start of the string
+    r"(?P<schoolcode>.+)_" # SCHOOL CODE
+    r"(?P<idx>.+)_"
+    r"(?P<nsctype>\w+)_"  # TYPE section
+    r"(?P<nscmode>\w+)_"  # MODE section
+    r"(?P<subdatetime>\d{8}\d{6})_"  # Date and time section
+    r"(?P<fn>.+)\.(?P<ext>\w+)"  # File name and extension
+    r"$"  # End of the string
+)
+
+# Size of each SFTP read request, and of each chunk written to the local file
+SFTP_BLOCK_SIZE: Final[int] = 32768
+
+def download_one(file_attr: paramiko.SFTPAttributes, local_file_path: Path, cfg: Dict) -> None:
+    """
+    Download a single file from the NSC receive path on a connection borrowed from the pool.
+
+    Args:
+        file_attr (paramiko.SFTPAttributes): The attributes of the remote file, as returned by listdir_attr.
+        local_file_path (Path): Where to save the file locally.
+        cfg (Dict): The merged configuration dictionary.
+    """
+    remote_file_path = cfg["nsc"]["ftp"]["receive_path"] + "/" + file_attr.filename
+
+    with get_pool(cfg).acquire() as sftp:
+        # Prefetch the whole file so the read requests are pipelined instead of waiting on each block
+        with sftp.open(remote_file_path, "rb") as remote_file:
+            remote_file.MAX_REQUEST_SIZE = SFTP_BLOCK_SIZE
+            remote_file.prefetch(file_attr.st_size)
+            with open(local_file_path, "wb") as local_file:
+                while chunk := remote_file.read(SFTP_BLOCK_SIZE):
+                    local_file.write(chunk)
+
+    # Fix the timestamp on the new file to match the timestamp on the remote file
+    if file_attr.st_atime is not None and file_attr.st_mtime is not None:
+        os.utime(local_file_path, (file_attr.st_atime, file_attr.st_mtime))
+    else:
+        print(
+            f"Skipping timestamp update for {local_file_path.name} due to missing time attributes"
+        )
+
+def wait_for_import(
+    import_proc: subprocess.Popen, file_name: str, local_file_path: Path, file_datetime_str: str, current_date_time: str
+) -> Optional[Tuple]:
+    """
+    Wait for an import command to finish and report the result.
+
+    Args:
+        import_proc (subprocess.Popen): The running import command.
+        file_name (str): The name of the file on the NSC server.
+        local_file_path (Path): The downloaded file being imported.
+        file_datetime_str (str): The formatted timestamp of the file.
+        current_date_time (str): The formatted date and time of this run.
+
+    Returns:
+        Optional[Tuple]: The "Imported" row to write to the log file, or None if the import failed.
+    """
+    if import_proc.wait() != 0:
+        print(f"Import failed: {local_file_path}")
+        return None
+
+    print(f"Import successful: {local_file_path}")
+    return (
+        file_name,
+        local_file_path,
+        file_datetime_str,
+        "Imported",
+        current_date_time,
+    )
+
 def main():
     """
     Main function to load configuration, initialize log file, and connect to the NSC FTP/SFTP server.
@@ -71,36 +154,15 @@ def main():
     2. Initialize the log file if it does not exist.
     3. Open the log file for appending new log entries.
     """
-    # Open the model.yml file and load the contents into the model variable
-    try:
-        with open(CONFIG_FILE, "r", encoding="utf-8") as file:
-            ccdw_cfg: Dict = yaml.load(file, Loader=yaml.FullLoader)
-    except FileNotFoundError:
-        ccdw_cfg = {}
+    # Load and merge the cfg and nsccfg dictionaries
+    cfg: Dict = load_config(CONFIG_FILE, NSC_CONFIG_FILE)
 
-    try:
-        with open(NSC_CONFIG_FILE, "r", encoding="utf-8") as file:
-            nsc_cfg: Dict = yaml.load(file, Loader=yaml.FullLoader)
-    except FileNotFoundError:
-        nsc_cfg = {}
-
-    # Merge the cfg and nsccfg dictionaries
-    cfg = merge_dicts(ccdw_cfg, nsc_cfg)
-
-    # Delete the partial dictionaries
-    del ccdw_cfg
-    del nsc_cfg
+    # Compile the rename patterns once rather than for every file
+    for rename_cfg in cfg["nsc"]["rename"].values():
+        if "pattern" in rename_cfg:
+            rename_cfg["_compiled"] = re.compile(rename_cfg["pattern"])
 
     log_file = Path(cfg["nsc"]["local"]["log_file"])
-    if not log_file.exists():
-        # Create the log file if it does not exist
-        with open(log_file, mode='w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerow(["nsc_file_name", "local_file_name", "file_date_time", "status", "date_time"])
-
-    # Open the log file for appending
-    log_file_handle = open(log_file, mode='a', newline='', encoding='utf-8')
-    log_writer = csv.writer(log_file_handle)
 
     # Get the current date and time for the date_time column in the log file
     current_date_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -110,189 +172,202 @@ def main():
     # Connect to the NSC ftp site using the credentials in the config file. The connection is stored in the nsc variable under ftp.
     # Use SFTP to connect to the NSC site.
 
-    # Connect using SFTP
-    transport: Transport = paramiko.Transport((cfg["nsc"]["ftp"]["host"], int(cfg["nsc"]["ftp"]["port"])))
-    transport.connect(username=cfg["nsc"]["ftp"]["username"], password=cfg["nsc"]["ftp"]["password"])
-    sftp: Optional[paramiko.SFTPClient] = paramiko.SFTPClient.from_transport(transport)
-    print("Connected to SFTP server")
-
-    receive_path: str = cfg["nsc"]["ftp"]["receive_path"]
-    local_receive_path: str = cfg["nsc"]["local"]["receive_path"]
-    if sftp is not None:
-        sftp.chdir(receive_path)
-    else:
-        print("Failed to establish SFTP connection")
-        return
-
-    latest_file_time: Optional[float] = None
-    new_latest_file_time: Optional[float] = None
-    latest_file_path: Path = Path(local_receive_path) / "__Latest File Date"
-
-    # Get the timestamp of the latest file if it exists
-    if latest_file_path.exists():
-        latest_file_time = latest_file_path.stat().st_mtime
-
-    file_datetime: Optional[datetime] = None
-
-    added_base: Dict[str, str] = {}
-
-    # Iterate over the list of files and their attributes
-    for file_attr in sftp.listdir_attr():
-        file_name: str = file_attr.filename
-        if file_attr.st_mtime is not None:
-            file_datetime = datetime.fromtimestamp(file_attr.st_mtime)
-            
-
-        # Skip files that are not newer than the latest file
-        if (
-            latest_file_time is not None
-            and file_attr.st_mtime is not None
-            and file_attr.st_mtime <= latest_file_time
-        ):
-            continue
-
-        print(f"Downloading file: [{file_name}], Date and Time: {file_datetime}")
-
-        if added_base:
-            # Need to remove all the base variables from the previous iteration
-            for key in list(added_base.keys()):
-                del globals()[key]
-                added_base[key]
-
-        # The file names on the FTP server are in the format of "CCCCCCCC_IIIIII_TYPE_MODE_MMDDYYYYHHMMSS_fn.ext".
-        # The TYPE section is one of: AGGRRPT, ANALYSISRDY, CNTLRPT, or DETLRPT.
-        # The MODE section is one of: DA, SE, or PA.
-
-        # Use regular expression to extract parts of the file name
-        # The pattern is broken down into named groups for clarity
-        pattern = (
-            r"^"  # Start of the string
-            r"(?P<schoolcode>.+)_" # SCHOOL CODE
-            r"(?P<idx>.+)_"
-            r"(?P<nsctype>\w+)_"  # TYPE section
-            r"(?P<nscmode>\w+)_"  # MODE section
-            r"(?P<subdatetime>\d{8}\d{6})_"  # Date and time section
-            r"(?P<fn>.+)\.(?P<ext>\w+)"  # File name and extension
-            r"$"  # End of the string
-        )
-        
-
-        match = re.match(pattern, file_name)
-        if match:
-            named_groups = match.groupdict()
-            # Create global variables for each named group
-            for key, value in named_groups.items():
-                # print(f"Setting global variable {key} to {value}")
-                globals()[key] = value
-                added_base[key] = value
-
-            subdatetime_dt: datetime = datetime.strptime(globals()["subdatetime"], "%m%d%Y%H%M%S") or datetime.today()
-
-        import_cmd: str = ""
-        added: Dict[str, str] = {}
-
-        # Now, loop through the cfg["nsc"]["rename"] list to find a matching entry
-        for rename_entry in cfg["nsc"]["rename"]:
-
-            if added:
-                # Need to remove all the variables added from the previous iteration
-                for key in list(added.keys()):
-                    del globals()[key]
-                    del added[key]
-                
-            # If the modes equal, then we need to look at the pattern for a match
-            if ("mode" in cfg["nsc"]["rename"][rename_entry] and globals()["nscmode"] == cfg["nsc"]["rename"][rename_entry]["mode"]):
-
-                fn_match: Optional[re.Match] = None
-                if ("pattern" in cfg["nsc"]["rename"][rename_entry] and (fn_match := re.match(cfg["nsc"]["rename"][rename_entry]["pattern"], globals()["fn"]))):
-                    if fn_match:
+    try:
+        # Connect using SFTP. The connection used to list the files goes back to the pool and is
+        # reused by one of the download workers.
+        receive_path: str = cfg["nsc"]["ftp"]["receive_path"]
+        local_receive_path: str = cfg["nsc"]["local"]["receive_path"]
+        local_receive_dir: Path = Path(local_receive_path)
+        with get_pool(cfg).acquire() as sftp:
+            print("Connected to SFTP server")
+            file_attrs: List[paramiko.SFTPAttributes] = sftp.listdir_attr(receive_path)
+
+        latest_file_time: Optional[float] = None
+        new_latest_file_time: Optional[float] = None
+        latest_file_path: Path = local_receive_dir / "__Latest File Date"
+
+        # Get the timestamp of the latest file if it exists
+        if latest_file_path.exists():
+            latest_file_time = latest_file_path.stat().st_mtime
+
+        file_datetime_str: str = ""
+
+        # The files to download as (file_attr, file_datetime_str, local_file_path, import_cmd)
+        downloads: List[Tuple[paramiko.SFTPAttributes, str, Path, str]] = []
+        # The local files already taken by an entry in downloads
+        local_file_paths: Set[Path] = set()
+        # The log rows for the files not downloaded because a newer file has the same local name
+        skipped: List[Tuple] = []
+
+        # Sort the files newest first, so that the loop can stop at the first file that is not newer
+        # than the latest file. Files without a timestamp are always downloaded, so they go first.
+        file_attrs.sort(key=lambda a: (a.st_mtime is None, a.st_mtime or 0), reverse=True)
+
+        # Iterate over the list of files and their attributes
+        for file_attr in file_attrs:
+            file_name: str = file_attr.filename
+
+            # Stop at the first file that is not newer than the latest file, all the rest are older
+            if (
+                latest_file_time is not None
+                and file_attr.st_mtime is not None
+                and file_attr.st_mtime <= latest_file_time
+            ):
+                break
+
+            if file_attr.st_mtime is not None:
+                file_datetime_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(file_attr.st_mtime))
+
+            # Use the regular expression to extract parts of the file name. The named groups are
+            # used to fill in the rename "replace" strings.
+            match = NSC_FILENAME_RE.match(file_name)
+            ctx: Dict[str, Any] = match.groupdict() if match else {}
+            if match:
+                subdatetime_dt: datetime = datetime.strptime(ctx["subdatetime"], "%m%d%Y%H%M%S") or datetime.today()
+                ctx["subdatetime_dt"] = subdatetime_dt
+
+            import_cmd: str = ""
+            local_file_path: Path = local_receive_dir / file_name
+
+            # Now, loop through the cfg["nsc"]["rename"] list to find a matching entry
+            for rename_entry in cfg["nsc"]["rename"]:
+
+                # If the modes equal, then we need to look at the pattern for a match
+                if ("mode" in cfg["nsc"]["rename"][rename_entry] and ctx.get("nscmode") == cfg["nsc"]["rename"][rename_entry]["mode"]):
+
+                    # Start from the file name groups, without anything added by a previous entry
+                    ctx_iter: Dict[str, Any] = {**ctx}
+
+                    fn_match: Optional[re.Match] = None
+                    if ("pattern" in cfg["nsc"]["rename"][rename_entry] and (fn_match := cfg["nsc"]["rename"][rename_entry]["_compiled"].match(ctx["fn"]))):
                         print("Match found for :", rename_entry)
-                        # get the named groups from the regex match and create varables for each named group
-                        named_groups = fn_match.groupdict()
-                        for key, value in named_groups.items():
-                            globals()[key] = value
-                            # Save value in dictionary "added"
-                            added[key] = value
-                    else:
-                        continue
-
-                # Construct the new file name based on the merged_cfg["nsc"]["rename"][rename_entry]["replace"]
-                # The string in that entry is an f-string
-                local_file_name: str = cfg["nsc"]["rename"][rename_entry]["replace"].format(**globals())
-
-            else:
-                # If no matching entry is found, use the original file name
-
-                local_file_name = file_name
-
-            if "local_file_path" in globals():
-                del globals()["local_file_path"]
-            globals()["local_file_path"] = Path(local_receive_path) / local_file_name
-
-            if (globals()["nsctype"] == cfg["nsc"]["import"]["type"] and cfg["nsc"]["rename"][rename_entry]["import"]):
-                # Get the import command from cfg["nsc"]["import"]
-                import_cmd = f"""
-                    python {cfg["nsc"]["import"]["cmd"].format(fn=local_file_path, 
-                                                                  dt=CURRENT_DATETIME_STR,
-                                                                  entry=rename_entry)}
-                                                                  """.strip()
-                # replace the './' with the path to the script
-                import_cmd = import_cmd.replace("./", str(SCRIPT_PATH) + "/").replace("\\", "/")
-
-        # Download the file and save it to cfg["nsc"]["local"]["receive_path"]
-        sftp.get(file_name, globals()["local_file_path"])
-
-        # Fix the timestamp on the new file to match the timestamp on the remote file
-        if file_attr.st_atime is not None and file_attr.st_mtime is not None:
-            os.utime(globals()["local_file_path"], (file_attr.st_atime, file_attr.st_mtime))
-        else:
-            print(
-                f"Skipping timestamp update for {local_file_name} due to missing time attributes"
-            )
-
-        # Update the latest file time
-        if new_latest_file_time is None or (
-            file_attr.st_mtime is not None and file_attr.st_mtime > new_latest_file_time
-        ):
-            new_latest_file_time = file_attr.st_mtime
-
-
-        # Write the file information to the log file
-        log_writer.writerow(
-            [
-                file_name,
-                local_file_path,
-                file_datetime.strftime("%Y-%m-%d %H:%M:%S"),
-                "Downloaded",
-                current_date_time,
-            ]
+                        # get the named groups from the regex match and add them to the names available to "replace"
+                        ctx_iter.update(fn_match.groupdict())
+
+                    # Construct the new file name based on the merged_cfg["nsc"]["rename"][rename_entry]["replace"]
+                    # The string in that entry is an f-string
+                    local_file_name: str = cfg["nsc"]["rename"][rename_entry]["replace"].format_map(ctx_iter)
+
+                else:
+                    # If no matching entry is found, use the original file name
+
+                    local_file_name = file_name
+
+                local_file_path = local_receive_dir / local_file_name
+
+                if (ctx.get("nsctype") == cfg["nsc"]["import"]["type"] and cfg["nsc"]["rename"][rename_entry]["import"]):
+                    # Get the import command from cfg["nsc"]["import"]
+                    import_cmd = f"""
+                        python {cfg["nsc"]["import"]["cmd"].format(fn=local_file_path, 
+                                                                      dt=CURRENT_DATETIME_STR,
+                                                                      entry=rename_entry)}
+                                                                      """.strip()
+                    # replace the './' with the path to the script
+                    import_cmd = import_cmd.replace("./", str(SCRIPT_PATH) + "/").replace("\\", "/")
+
+            # Several files can be renamed to the same local file. Only the first one, which is the newest,
+            # is downloaded, so that two workers never write to the same file at the same time. The others
+            # are logged as skipped.
+            if local_file_path in local_file_paths:
+                print(f"Skipping file: [{file_name}], a newer file is already saved as {local_file_path}")
+                skipped.append((file_name, local_file_path, file_datetime_str, "Skipped", current_date_time))
+                continue
+            local_file_paths.add(local_file_path)
+
+            print(f"Downloading file: [{file_name}], Date and Time: {file_datetime_str}")
+            downloads.append((file_attr, file_datetime_str, local_file_path, import_cmd))
+
+        # Download the files in parallel, each worker thread using its own pooled SFTP connection.
+        # The log and the latest file time are only updated from this thread as downloads complete.
+        # The running imports as (import_proc, file_name, local_file_path, file_datetime_str)
+        running_imports: Deque[Tuple[subprocess.Popen, str, Path, str]] = deque()
+        import_concurrency: int = cfg["nsc"].get("import_concurrency", 4)
+
+        # Open the log file for appending. The rows are written from a background thread.
+        log = AsyncCSVLogger(
+            log_file, ["nsc_file_name", "local_file_name", "file_date_time", "status", "date_time"], buffering=1 << 20
         )
 
-        # If an import command is specified, execute it
-        if import_cmd:
-            print(f"Running import command: {import_cmd}")
-            # Check if os.system call was successful and log the result
-            if os.system(import_cmd) == 0:
-                print("Import successful")
-                # Write the import information to the log file, if successful
-                log_writer.writerow(
-                    [
-                        file_name,
-                        local_file_path,
-                        file_datetime.strftime("%Y-%m-%d %H:%M:%S"),
-                        "Imported",
-                        current_date_time,
-                    ]
-                )
-            else:
-                print("Import failed")
-
-    if new_latest_file_time is not None:
-        latest_file_path.touch()
-        os.utime(latest_file_path, (new_latest_file_time, new_latest_file_time))
-
-    print("Done")
-    log_file_handle.close()
+        # The errors raised by failed downloads, re-raised once every other file has been logged
+        errors: List[Exception] = []
+
+        try:
+            for row in skipped:
+                log.write(row)
+
+            with ThreadPoolExecutor(max_workers=cfg["nsc"].get("concurrency", 8)) as executor:
+                futures = {
+                    executor.submit(download_one, file_attr, local_file_path, cfg): (file_attr, file_datetime_str, local_file_path, import_cmd)
+                    for file_attr, file_datetime_str, local_file_path, import_cmd in downloads
+                }
+
+                for future in as_completed(futures):
+                    file_attr, file_datetime_str, local_file_path, import_cmd = futures[future]
+                    file_name = file_attr.filename
+
+                    # Carry on with the other files if this download failed, so that they are still logged
+                    try:
+                        future.result()
+                    except Exception as error:
+                        print(f"Download failed: [{file_name}], {error}")
+                        errors.append(error)
+                        continue
+
+                    # Update the latest file time
+                    if new_latest_file_time is None or (
+                        file_attr.st_mtime is not None and file_attr.st_mtime > new_latest_file_time
+                    ):
+                        new_latest_file_time = file_attr.st_mtime
+
+                    # Write the file information to the log file
+                    log.write(
+                        (
+                            file_name,
+                            local_file_path,
+                            file_datetime_str,
+                            "Downloaded",
+                            current_date_time,
+                        )
+                    )
+
+                    # If an import command is specified, start it. It runs while the next files download.
+                    if import_cmd:
+                        # Wait for the oldest import to finish if too many are already running
+                        if len(running_imports) >= import_concurrency:
+                            if (import_row := wait_for_import(*running_imports.popleft(), current_date_time)):
+                                log.write(import_row)
+
+                        print(f"Running import command: {import_cmd}")
+                        try:
+                            import_proc = subprocess.Popen(shlex.split(import_cmd))
+                        except OSError as error:
+                            # The command could not be started at all, e.g. python is not on the PATH
+                            print(f"Import failed: {local_file_path}, {error}")
+                        else:
+                            running_imports.append((import_proc, file_name, local_file_path, file_datetime_str))
+        finally:
+            try:
+                # Wait for the remaining imports, even if a download failed, and write the import information
+                # to the log file if successful
+                while running_imports:
+                    if (import_row := wait_for_import(*running_imports.popleft(), current_date_time)):
+                        log.write(import_row)
+            finally:
+                # Write out whatever is left and close the log file
+                log.close()
+
+        # Leave the latest file time alone, so that the failed files are downloaded again on the next run
+        if errors:
+            raise errors[0]
+
+        if new_latest_file_time is not None:
+            latest_file_path.touch()
+            os.utime(latest_file_path, (new_latest_file_time, new_latest_file_time))
+
+        print("Done")
+    finally:
+        # Close the pooled SFTP connections, even if listing or downloading failed
+        close_pools()
 
 if __name__ == "__main__":
     main()
@@ -3,13 +3,14 @@ This script connects to an NSC FTP/SFTP server, retrieves files, and logs the op
 
 Modules:
     os: Provides a way of using operating system dependent functionality.
-    re: Provides regular expression matching operations.
+    shutil: Moves uploaded files to the archive directory across file systems.
+    time: Formats the file timestamps for the log file.
+    concurrent.futures: Runs the SFTP uploads on a pool of worker threads.
     datetime: Supplies classes for manipulating dates and times.
     pathlib: Offers classes to handle filesystem paths.
     typing: Provides runtime support for type hints.
-    csv: Implements classes to read and write tabular data in CSV format.
-    paramiko: Implements the SSH2 protocol for secure (encrypted and authenticated) connections to remote machines.
-    yaml: Provides YAML parsing and emitting capabilities.
+    sftp_pool: A pool of open SFTP connections to the NSC server.
+    support_scripts: Shared helpers for locating and loading the YAML configuration and writing the log file.
 
 Constants:
     CURRENT_DATETIME: The current date and time when the script is run.
@@ -25,17 +26,17 @@ These items need to be replaced with a more dynamic approach (see pycolleague fo
 # %% Initialize
 
 import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict, Final, Optional
+from typing import Dict, Final, List, Optional, Tuple
 from datetime import datetime
 
-import csv
-import paramiko
-import yaml
-from paramiko import Transport
 from pathlib import Path
 
-from support_scripts import find_root, merge_dicts
+from sftp_pool import SFTPConnectionPool, close_pools, get_pool
+from support_scripts import AsyncCSVLogger, find_root, load_config, load_yaml_or_empty
 
 # %% Constants
 CURRENT_DATETIME: Final[datetime] = datetime.now()
@@ -43,12 +44,81 @@ CURRENT_DATETIME: Final[datetime] = datetime.now()
 # Get current datetime as YYYYMMDD_HHMMSS
 CURRENT_DATETIME_STR: Final[str] = CURRENT_DATETIME.strftime("%Y%m%d_%H%M%S")
 
+# The date_time column of the log file, converted to text once rather than by csv for every row
+CURRENT_DATETIME_LOG_STR: Final[str] = str(CURRENT_DATETIME)
+
 ROOT_PATH: Final[Path] = find_root("_IERG_SHARED_ROOT_DIR_")
 NSC_PATH: Final[Path] = Path(ROOT_PATH / Path("nsc"))
 DATA_PATH: Final[Path] = Path(ROOT_PATH / Path("Data"))
 CONFIG_FILE: Final[Path] = Path(DATA_PATH / "config1.yml")
 NSC_CONFIG_FILE: Final[Path] = Path(NSC_PATH / "nscconfig.yml")
 
+# Size of each SFTP write request. OpenSSH's sftp-server rejects messages over 256 KiB, so stay below that.
+SFTP_BLOCK_SIZE: Final[int] = 1 << 17
+
+def upload_one(
+    local_file: str,
+    file_name: str,
+    mtime: float,
+    pool: SFTPConnectionPool,
+    send_path: str,
+    archive_path: str,
+    same_fs: bool,
+) -> Tuple[Tuple, Optional[OSError]]:
+    """
+    Upload a single file on a connection borrowed from the pool, then move it to the archive.
+
+    The file is on the NSC server once the upload succeeds, so a failure to archive it is returned
+    rather than raised, so that the upload is still logged.
+
+    Args:
+        local_file (str): The path of the file to upload.
+        file_name (str): The name of the file, without its directory.
+        mtime (float): The modification time of the file, taken when the directory was listed.
+        pool (SFTPConnectionPool): The pool to borrow the SFTP connection from.
+        send_path (str): The remote directory to upload the file to.
+        archive_path (str): The local directory the file is moved to once uploaded.
+        same_fs (bool): Whether archive_path is on the same file system as the file.
+
+    Returns:
+        Tuple[Tuple, Optional[OSError]]: The row to write to the log file for this file, and the error
+            raised when moving it to the archive, or None if it was archived.
+    """
+    remote_file = send_path + '/' + file_name
+    print(f"Uploading file: {local_file} to {remote_file}")
+    with pool.acquire() as sftp:
+        # Pipeline the writes in large requests, without waiting for each one to be acknowledged
+        with open(local_file, "rb") as file, sftp.open(remote_file, "wb") as remote:
+            remote.set_pipelined(True)
+            remote.MAX_REQUEST_SIZE = SFTP_BLOCK_SIZE
+            while chunk := file.read(SFTP_BLOCK_SIZE):
+                remote.write(chunk)
+
+    # Get the file's timestamp
+    file_timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mtime))
+
+    row = (
+        file_name,
+        remote_file,
+        file_timestamp,
+        "Uploaded",
+        CURRENT_DATETIME_LOG_STR,
+    )
+
+    # Move the file to the archivePathwith the current date appended
+    stem, suffix = os.path.splitext(file_name)
+    archive_file = os.path.join(archive_path, f"{stem}_{CURRENT_DATETIME_STR}{suffix}")
+    try:
+        if same_fs:
+            os.replace(local_file, archive_file)
+        else:
+            # A rename cannot cross file systems, so the file has to be copied
+            shutil.move(local_file, archive_file)
+    except OSError as error:
+        return row, error
+
+    return row, None
+
 def main():
     """
     Main function to load configuration, initialize log file, and connect to the NSC FTP/SFTP server.
@@ -59,86 +129,78 @@ def main():
     3. Open the log file for appending new log entries.
     """
 
-    try:
-        with open(CONFIG_FILE, "r", encoding="utf-8") as file:
-            ccdw_cfg: Dict = yaml.load(file, Loader=yaml.FullLoader)
-    except FileNotFoundError:
-        ccdw_cfg = {}
-
-    try:
-        with open(NSC_CONFIG_FILE, "r", encoding="utf-8") as file:
-            nsc_cfg: Dict = yaml.load(file, Loader=yaml.FullLoader)
-    except FileNotFoundError:
-        nsc_cfg = {}
-
-    # Merge the cfg and nsccfg dictionaries
-    cfg = merge_dicts(ccdw_cfg, nsc_cfg)
-
-    # Delete the partial dictionaries
-    del ccdw_cfg
-    del nsc_cfg
-    send_path: str = cfg["nsc"]["ftp"]["send_path"]
-    local_send_path: str = cfg["nsc"]["local"]["send_path"]
-    archive_path: str = cfg["nsc"]["local"]["archive_path"]
-    log_file = Path(cfg["nsc"]["local"]["log_file"])
+    # The NSC config takes precedence over the shared config, so if it sets the local send path
+    # check that directory first and skip loading the shared config when there is nothing to send
+    probe_send_path = load_yaml_or_empty(NSC_CONFIG_FILE).get("nsc", {}).get("local", {}).get("send_path")
+    if probe_send_path is not None:
+        with os.scandir(probe_send_path) as entries:
+            if not any(entry.is_file() for entry in entries):
+                print("No files to send")
+                return
+
+    # Load and merge the cfg and nsccfg dictionaries
+    cfg: Dict = load_config(CONFIG_FILE, NSC_CONFIG_FILE)
+
+    # Look up the settings once
+    nsc_cfg: Dict = cfg["nsc"]
+    ftp_cfg: Dict = nsc_cfg["ftp"]
+    local_cfg: Dict = nsc_cfg["local"]
+    send_path: str = ftp_cfg["send_path"]
+    local_send_path: str = local_cfg["send_path"]
+    archive_path: str = os.fspath(local_cfg["archive_path"])
+    log_file = Path(local_cfg["log_file"])
+    upload_concurrency: int = nsc_cfg.get("upload_concurrency", 8)
 
     # Check if there are files to send
-    files_to_send = [local_file for local_file in Path(local_send_path).iterdir() if local_file.is_file()]
+    # scandir reuses the file type from the directory listing instead of calling stat on every entry.
+    # The name and modification time are kept with each file so they do not need to be looked up again.
+    with os.scandir(local_send_path) as entries:
+        files_to_send = [(entry.path, entry.name, entry.stat().st_mtime) for entry in entries if entry.is_file()]
     if not files_to_send:
         print("No files to send")
         return
 
-    # Check if the log file exists and write headers if it does not
-    if not log_file.exists():
-        with open(log_file, mode='w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerow(["file_name", "remote_file", "file_date_time", "status", "date_time"])
-
-    # Open the log file for appending
-    log_file_handle = open(log_file, mode='a', newline='', encoding='utf-8')
-    log_writer = csv.writer(log_file_handle)
-
-    # Connect using SFTP
-    transport: Transport = paramiko.Transport((cfg["nsc"]["ftp"]["host"], int(cfg["nsc"]["ftp"]["port"])))
-    transport.connect(username=cfg["nsc"]["ftp"]["username"], password=cfg["nsc"]["ftp"]["password"])
-    sftp: Optional[paramiko.SFTPClient] = paramiko.SFTPClient.from_transport(transport)
-    print("Connected to SFTP server")
-
-    if sftp is not None:
-        sftp.chdir(send_path)
-    else:
-        print("Failed to establish SFTP connection")
-        return
+    # Check once whether the archived files can simply be renamed
+    same_fs: bool = os.stat(local_send_path).st_dev == os.stat(archive_path).st_dev
+
+    # The errors raised by failed uploads and archives, re-raised once every other file has been logged
+    errors: List[Exception] = []
 
-    # Iterate over the list of files in the local send path
-    for local_file in files_to_send:
-        remote_file = send_path + '/' + local_file.name
-        print(f"Uploading file: {local_file} to {remote_file}")
-        sftp.put(local_file, remote_file)
-
-        # Get the file's timestamp
-        file_timestamp = datetime.fromtimestamp(local_file.stat().st_mtime).strftime("%Y-%m-%d %H:%M:%S")
-
-        # Write the file information to the log file
-        log_writer.writerow(
-            [
-                local_file.name,
-                remote_file,
-                file_timestamp,
-                "Uploaded",
-                CURRENT_DATETIME,
-            ]
-        )
-
-        # Move the file to the archivePathwith the current date appended
-        archive_file_name = f"{local_file.stem}_{CURRENT_DATETIME_STR}{local_file.suffix}"
-        archive_file = Path(archive_path) / archive_file_name
-        local_file.rename(archive_file)
-
-    print("Done")
-    log_file_handle.close()
-    sftp.close()
-    transport.close()
+    try:
+        # Open the log file for appending, writing the headers if it does not exist yet. The rows are
+        # written from a background thread, and the file is closed even if an upload fails.
+        with AsyncCSVLogger(
+            log_file, ["file_name", "remote_file", "file_date_time", "status", "date_time"], buffering=65536
+        ) as log:
+            # Upload the files in parallel, each worker thread using its own pooled SFTP connection.
+            pool = get_pool(cfg)
+            with ThreadPoolExecutor(max_workers=upload_concurrency) as executor:
+                futures = {
+                    executor.submit(upload_one, local_file, file_name, mtime, pool, send_path, archive_path, same_fs): file_name
+                    for local_file, file_name, mtime in files_to_send
+                }
+                for future in as_completed(futures):
+                    # The other files are uploaded and archived whether or not this one failed, so keep logging them
+                    try:
+                        row, archive_error = future.result()
+                    except Exception as error:
+                        print(f"Upload failed: [{futures[future]}], {error}")
+                        errors.append(error)
+                        continue
+
+                    # The file is on the NSC server, so log it even if it could not be archived
+                    log.write(row)
+                    if archive_error is not None:
+                        print(f"Archive failed: [{futures[future]}], {archive_error}")
+                        errors.append(archive_error)
+
+        if errors:
+            raise errors[0]
+
+        print("Done")
+    finally:
+        # Close the pooled SFTP connections, even if an upload failed
+        close_pools()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,308 @@
+"""
+A small pool of open SFTP connections to the NSC server.
+
+Opening an SFTP session costs a TCP connect, the SSH handshake, key exchange and authentication.
+The pool keeps sessions open once they have been created so that repeated transfers, or several
+worker threads, reuse them instead of reconnecting for every file.
+
+Paramiko clients are not thread-safe, so each client handed out by the pool is used by only one
+thread at a time. Each client runs on its own channel, and several channels can share one
+Transport, so that many clients only pay for a single SSH handshake.
+"""
+
+import queue
+import socket
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+import paramiko
+
+from support_scripts import get_secrets
+
+# Open pools, keyed by (host, port, username)
+_POOLS: Dict[Tuple[str, int, str], "SFTPConnectionPool"] = {}
+_POOLS_LOCK = threading.Lock()
+
+# Kernel send/receive buffer size requested for SFTP sockets
+SOCKET_BUFFER_SIZE = 32 * 1024 * 1024
+
+# SSH channel window and maximum packet size, large enough to keep a high-latency link busy
+WINDOW_SIZE = 64 * 1024 * 1024
+MAX_PACKET_SIZE = 1 * 1024 * 1024
+
+# Bytes sent or received before the transport renegotiates its keys
+REKEY_BYTES = 1 << 40
+
+# Ciphers and MACs to offer first, when paramiko supports them. AES-GCM runs on the CPU's AES
+# instructions and needs no separate MAC, and the encrypt-then-MAC digests are cheaper than the rest.
+PREFERRED_CIPHERS = (
+    "aes128-gcm@openssh.com",
+    "aes256-gcm@openssh.com",
+    "chacha20-poly1305@openssh.com",
+    "aes128-ctr",
+    "aes256-ctr",
+)
+PREFERRED_DIGESTS = (
+    "hmac-sha2-256-etm@openssh.com",
+    "hmac-sha2-512-etm@openssh.com",
+)
+
+
+def _prefer(preferred: Tuple[str, ...], available: Tuple[str, ...]) -> Tuple[str, ...]:
+    """
+    Reorder the available algorithms so the preferred ones come first, in the preferred order.
+
+    Args:
+        preferred (Tuple[str, ...]): The algorithms to move to the front.
+        available (Tuple[str, ...]): The algorithms supported by paramiko.
+
+    Returns:
+        Tuple[str, ...]: The available algorithms, with the supported preferred ones first.
+    """
+    return tuple(name for name in preferred if name in available) + tuple(
+        name for name in available if name not in preferred
+    )
+
+
+def open_tuned_sock(host: str, port: int) -> socket.socket:
+    """
+    Open a TCP connection tuned for bulk transfers.
+
+    Nagle's algorithm is disabled and large kernel buffers are requested before connecting, so
+    that the TCP window can grow enough to keep a high-latency link busy. Each address the host
+    name resolves to is tried in turn, like paramiko does, until one of them connects.
+
+    Args:
+        host (str): The host name to connect to.
+        port (int): The port to connect to.
+
+    Returns:
+        socket.socket: The connected socket.
+    """
+    last_error: Optional[OSError] = None
+    for family, socktype, proto, _, address in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM):
+        try:
+            sock = socket.socket(family, socktype, proto)
+        except OSError as error:
+            last_error = error
+            continue
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+            sock.connect(address)
+        except OSError as error:
+            # Close this socket and try the next address, e.g. IPv4 after an unreachable IPv6 address
+            sock.close()
+            last_error = error
+            continue
+        return sock
+
+    if last_error is None:
+        last_error = OSError(f"No addresses found for {host}")
+    raise last_error
+
+
+class SFTPConnectionPool:
+    """
+    A pool of open SFTP clients for a single server and user.
+
+    Args:
+        host (str): The SFTP server host name.
+        port (int): The SFTP server port.
+        username (str): The user name to log in with.
+        password (str): The password to log in with.
+        size (int, optional): The maximum number of idle clients kept open. Defaults to 8.
+        channels_per_transport (int, optional): The number of clients opened on the same
+            Transport before a new one is started. Defaults to 1.
+    """
+
+    def __init__(
+        self, host: str, port: int, username: str, password: str, size: int = 8, channels_per_transport: int = 1
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self._password = password
+        self._idle: "queue.Queue[paramiko.SFTPClient]" = queue.Queue(maxsize=size)
+        self._channels_per_transport = max(1, channels_per_transport)
+        # The number of open clients on each Transport
+        self._transports: Dict[paramiko.Transport, int] = {}
+        self._lock = threading.Lock()
+
+    def _open_transport(self) -> paramiko.Transport:
+        """
+        Open and authenticate a new Transport to the server.
+
+        Returns:
+            paramiko.Transport: The connected Transport.
+        """
+        transport = paramiko.Transport(
+            open_tuned_sock(self.host, self.port),
+            default_window_size=WINDOW_SIZE,
+            default_max_packet_size=MAX_PACKET_SIZE,
+        )
+        # Avoid stalling large transfers on a key renegotiation part way through
+        transport.packetizer.REKEY_BYTES = REKEY_BYTES
+        # Offer the fastest ciphers first. The others stay in the list, so servers without them still work.
+        options = transport.get_security_options()
+        options.ciphers = _prefer(PREFERRED_CIPHERS, options.ciphers)
+        options.digests = _prefer(PREFERRED_DIGESTS, options.digests)
+        try:
+            transport.connect(username=self.username, password=self._password)
+        except BaseException:
+            # The Transport is not in the pool yet, so close_pools() cannot close it
+            transport.close()
+            raise
+        return transport
+
+    def _connect(self) -> paramiko.SFTPClient:
+        """
+        Open a new SFTP client, on an open Transport with a free channel or else on a new one.
+
+        Returns:
+            paramiko.SFTPClient: The connected SFTP client.
+        """
+        transport = None
+        with self._lock:
+            for candidate, channels in self._transports.items():
+                if channels < self._channels_per_transport and candidate.is_active():
+                    transport = candidate
+                    self._transports[candidate] += 1
+                    break
+
+        if transport is None:
+            # Connect outside the lock, so that other threads are not held up by the handshake
+            transport = self._open_transport()
+            with self._lock:
+                self._transports[transport] = 1
+
+        try:
+            sftp = paramiko.SFTPClient.from_transport(transport)
+            if sftp is None:
+                raise ConnectionError("Failed to establish SFTP connection")
+        except BaseException:
+            self._release_channel(transport)
+            raise
+        return sftp
+
+    def _release_channel(self, transport: paramiko.Transport) -> None:
+        """
+        Record that a client on the Transport was closed, closing the Transport with its last client.
+
+        Args:
+            transport (paramiko.Transport): The Transport the client was opened on.
+        """
+        with self._lock:
+            self._transports[transport] -= 1
+            last_channel = self._transports[transport] <= 0
+            if last_channel:
+                del self._transports[transport]
+        if last_channel:
+            transport.close()
+
+    @staticmethod
+    def _is_active(sftp: paramiko.SFTPClient) -> bool:
+        transport = sftp.get_channel().get_transport()
+        return transport is not None and transport.is_active()
+
+    def _close(self, sftp: paramiko.SFTPClient) -> None:
+        transport = sftp.get_channel().get_transport()
+        sftp.close()
+        self._release_channel(transport)
+
+    @contextmanager
+    def acquire(self) -> Iterator[paramiko.SFTPClient]:
+        """
+        Borrow an SFTP client from the pool, opening a new one if none are idle.
+
+        The client is returned to the pool when the block exits normally, and closed if the
+        block raises, since it may have been left in an unknown state.
+
+        Yields:
+            paramiko.SFTPClient: A connected SFTP client.
+        """
+        sftp = None
+        while sftp is None:
+            try:
+                sftp = self._idle.get_nowait()
+            except queue.Empty:
+                sftp = self._connect()
+            else:
+                # Drop connections the server has closed while they sat in the pool
+                if not self._is_active(sftp):
+                    self._close(sftp)
+                    sftp = None
+
+        try:
+            yield sftp
+        except BaseException:
+            self._close(sftp)
+            raise
+        self.release(sftp)
+
+    def release(self, sftp: paramiko.SFTPClient) -> None:
+        """
+        Return an SFTP client to the pool, closing it if the pool is already full.
+
+        Args:
+            sftp (paramiko.SFTPClient): The client to return.
+        """
+        if not self._is_active(sftp):
+            self._close(sftp)
+            return
+        try:
+            self._idle.put_nowait(sftp)
+        except queue.Full:
+            self._close(sftp)
+
+    def close(self) -> None:
+        """
+        Close all the idle clients in the pool.
+        """
+        while True:
+            try:
+                sftp = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._close(sftp)
+
+
+def get_pool(cfg: Dict) -> SFTPConnectionPool:
+    """
+    Get the connection pool for the NSC server in the config, creating it on first use.
+
+    A password given as a 1Password secret reference ("op://...") is read with get_secrets.
+
+    Args:
+        cfg (Dict): The merged configuration dictionary.
+
+    Returns:
+        SFTPConnectionPool: The pool for cfg["nsc"]["ftp"], sized to cfg["nsc"]["concurrency"], with up to
+            cfg["nsc"]["channels_per_connection"] clients sharing each connection.
+    """
+    ftp_cfg = cfg["nsc"]["ftp"]
+    key = (ftp_cfg["host"], int(ftp_cfg["port"]), ftp_cfg["username"])
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            password: str = ftp_cfg["password"]
+            if password.startswith("op://"):
+                password = get_secrets(password)
+            _POOLS[key] = SFTPConnectionPool(
+                *key,
+                password=password,
+                size=cfg["nsc"].get("concurrency", 8),
+                channels_per_transport=cfg["nsc"].get("channels_per_connection", 1),
+            )
+        return _POOLS[key]
+
+
+def close_pools() -> None:
+    """
+    Close every open connection in every pool.
+    """
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.close()
+        _POOLS.clear()
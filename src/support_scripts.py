@@ -1,10 +1,43 @@
+import copy
+import csv
+import functools
+import os
+import pickle
+import queue
+import stat
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Iterable, List, TextIO
+
+import yaml
+
+__all__ = [
+    "AsyncCSVLogger",
+    "find_root",
+    "get_secrets",
+    "load_config",
+    "load_yaml_cached",
+    "load_yaml_or_empty",
+    "merge_dicts",
+    "open_log",
+]
+
+try:
+    # The libyaml C parser is much faster, but is only available if PyYAML was built against libyaml
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
 
 def find_root(file_name, start_path=None):
     """
     Recursively find the root directory containing a specific file.
 
+    The result is cached, so repeated lookups from the same starting directory do not walk the
+    file system again.
+
     Args:
         file_name (str): The name of the file to search for.
         start_path (str or Path, optional): The starting directory. Defaults to the current working directory.
@@ -12,17 +45,244 @@ def find_root(file_name, start_path=None):
     Returns:
         Path: The Path object for the directory containing the file, or the current directory if not found.
     """
-    start_path = Path(start_path or Path.cwd())
-    for parent in start_path.parents:
-        if (parent / file_name).exists():
-            return parent
-    return Path.cwd()
+    return _find_root(file_name, str(start_path or os.getcwd()))
 
-def merge_dicts(cfg1: Dict, cfg2: Dict) -> Dict:
-    merged = cfg1.copy()  # Start with the values in cfg
-    for key, value in cfg2.items():
-        if isinstance(value, dict) and key in merged:
-            merged[key] = merge_dicts(merged[key], value)
+@functools.lru_cache(maxsize=32)
+def _find_root(file_name: str, start_path: str) -> Path:
+    # Walk up with plain strings, only building a Path for the result
+    path = os.path.abspath(start_path)
+    while True:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return Path.cwd()
+        try:
+            os.lstat(os.path.join(parent, file_name))
+        except FileNotFoundError:
+            path = parent
         else:
-            merged[key] = value
-    return merged
\ No newline at end of file
+            return Path(parent)
+
+def merge_dicts(cfg1: Dict, cfg2: Dict) -> Dict:
+    """
+    Merge two nested dictionaries, with the values in cfg2 taking precedence.
+
+    Args:
+        cfg1 (Dict): The base dictionary.
+        cfg2 (Dict): The dictionary whose values are merged on top of cfg1.
+
+    Returns:
+        Dict: The merged dictionary. Neither argument is modified.
+    """
+    merged = copy.deepcopy(cfg1)  # Start with the values in cfg, copied once at every level
+    stack = [(merged, cfg2)]
+    while stack:
+        dst, src = stack.pop()
+        for key, value in src.items():
+            if isinstance(value, dict) and isinstance(dst.get(key), dict):
+                stack.append((dst[key], value))
+            else:
+                dst[key] = value
+    return merged
+
+def _is_trusted(cache_stat: os.stat_result) -> bool:
+    # Only trust a cache owned by this user that nobody else can write to. Windows has no
+    # POSIX owner or mode bits to check.
+    if not hasattr(os, "getuid"):
+        return True
+    return cache_stat.st_uid == os.getuid() and not cache_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def load_yaml_cached(path: Path) -> Dict:
+    """
+    Load a YAML file, reusing a pickled copy of the parsed contents when the file has not changed.
+
+    The parsed contents are saved next to the YAML file as "<name>.cache.pkl", together with the
+    modification time and size of the YAML file they were parsed from. The cache is only used
+    while both still match the YAML file.
+
+    The cache holds the same credentials as the YAML file, so it is created readable by its owner
+    only. Unpickling runs code chosen by whoever wrote the file, so on POSIX systems a cache that is
+    owned by another user, or writable by group or others, is ignored. On Windows, anyone who can
+    write to the config directory can run code in this process through the cache.
+
+    Args:
+        path (Path): The YAML file to load.
+
+    Returns:
+        Dict: The parsed contents of the YAML file.
+
+    Raises:
+        FileNotFoundError: If the YAML file does not exist.
+    """
+    path = Path(path)
+    cache_path = path.with_suffix(path.suffix + ".cache.pkl")
+    yaml_stat = path.stat()
+
+    try:
+        with open(cache_path, "rb") as file:
+            if not _is_trusted(os.fstat(file.fileno())):
+                raise PermissionError(f"Untrusted cache file: {cache_path}")
+            cached_mtime, cached_size, cached_cfg = pickle.load(file)
+        if (cached_mtime, cached_size) == (yaml_stat.st_mtime_ns, yaml_stat.st_size):
+            return cached_cfg
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+        # Missing, unreadable or old format cache, parse the YAML file instead
+        pass
+
+    # Pass the raw bytes, so the UTF-8 decoding happens inside the parser
+    with open(path, "rb") as file:
+        cfg: Dict = yaml.load(file, Loader=_Loader)
+
+    try:
+        # Write to a temporary file, which mkstemp creates with mode 0o600, and rename it into place,
+        # so that a script running at the same time never reads a half-written cache
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, prefix=cache_path.name + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                pickle.dump((yaml_stat.st_mtime_ns, yaml_stat.st_size, cfg), file, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        # The cache is only an optimization, so a read-only config directory is fine
+        pass
+
+    return cfg
+
+def load_yaml_or_empty(path: Path) -> Dict:
+    """
+    Load a YAML file with load_yaml_cached, treating a missing or empty file as an empty dictionary.
+
+    Args:
+        path (Path): The YAML file to load.
+
+    Returns:
+        Dict: The parsed contents of the YAML file.
+    """
+    try:
+        return load_yaml_cached(path) or {}
+    except FileNotFoundError:
+        return {}
+
+def load_config(config_file: Path, nsc_config_file: Path) -> Dict:
+    """
+    Load the shared configuration and the NSC configuration, and merge them.
+
+    The two files are loaded in parallel. A missing or empty file is treated as an empty configuration.
+
+    Args:
+        config_file (Path): The shared configuration file.
+        nsc_config_file (Path): The NSC configuration file, whose values take precedence.
+
+    Returns:
+        Dict: The merged configuration.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        ccdw_future = executor.submit(load_yaml_or_empty, config_file)
+        nsc_future = executor.submit(load_yaml_or_empty, nsc_config_file)
+        ccdw_cfg, nsc_cfg = ccdw_future.result(), nsc_future.result()
+
+    # Merge the cfg and nsccfg dictionaries
+    return merge_dicts(ccdw_cfg, nsc_cfg)
+
+@functools.lru_cache(maxsize=None)
+def get_secrets(password: str) -> str:
+    """
+    Read a secret from 1Password with the op CLI.
+
+    Each secret reference is only looked up once per run.
+
+    Args:
+        password (str): The 1Password secret reference, e.g. "op://vault/item/password".
+
+    Returns:
+        str: The value of the secret.
+    """
+    # Only capture stdout, so that op's own error message, e.g. when not signed in, reaches the console
+    return subprocess.run(["op", "read", password], stdout=subprocess.PIPE, text=True, check=True).stdout.strip()
+
+def open_log(log_file: Path, header: List[str], buffering: int = -1) -> TextIO:
+    """
+    Open a CSV log file for appending, writing the header row first if the file does not exist.
+
+    Args:
+        log_file (Path): The log file to open.
+        header (List[str]): The column names written when the file is created.
+        buffering (int, optional): The buffer size passed to open(). Defaults to -1, the system default.
+
+    Returns:
+        TextIO: The log file, opened for appending.
+    """
+    try:
+        # Create the log file if it does not exist, without a separate exists() check
+        log_file_handle = open(log_file, mode='x', newline='', encoding='utf-8', buffering=buffering)
+    except FileExistsError:
+        return open(log_file, mode='a', newline='', encoding='utf-8', buffering=buffering)
+
+    writer = csv.writer(log_file_handle)
+    writer.writerow(header)
+    return log_file_handle
+
+class AsyncCSVLogger:
+    """
+    Append rows to a CSV log file from a background thread.
+
+    write() only queues the row, so the caller is never held up by the log file. The background
+    thread writes all the rows queued so far in one writerows() call. Use it as a context manager,
+    or call close(), to write out the remaining rows and close the file.
+
+    Args:
+        log_file (Path): The log file to append to.
+        header (List[str]): The column names written when the file is created.
+        buffering (int, optional): The buffer size passed to open(). Defaults to -1, the system default.
+    """
+
+    # Queued by close() to tell the background thread to stop
+    _STOP = object()
+
+    def __init__(self, log_file: Path, header: List[str], buffering: int = -1):
+        self._file = open_log(log_file, header, buffering=buffering)
+        self._writer = csv.writer(self._file)
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def _drain(self) -> None:
+        while True:
+            rows = [self._queue.get()]
+            # Take everything else already queued, so it goes out in a single write
+            while True:
+                try:
+                    rows.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = rows[-1] is self._STOP
+            if stop:
+                rows.pop()
+            self._writer.writerows(rows)
+            if stop:
+                return
+
+    def write(self, row: Iterable) -> None:
+        """
+        Queue a row to be written to the log file.
+
+        Args:
+            row (Iterable): The values for the row.
+        """
+        self._queue.put(row)
+
+    def close(self) -> None:
+        """
+        Write out the queued rows and close the log file.
+        """
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self._file.close()
+
+    def __enter__(self) -> "AsyncCSVLogger":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()